@@ -5,24 +5,35 @@ With TMDB integration, inline buttons, PostgreSQL storage.
 """
 
 import os
-import random
+import asyncio
+import atexit
 import logging
 import json
-from datetime import datetime
+import re
+import itertools
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from io import BytesIO
 
 import httpx
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
+    AIORateLimiter,
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
     filters,
 )
+from telegram.request import HTTPXRequest
 
 import urllib.parse
 
@@ -41,22 +52,190 @@ TMDB_API_KEY = os.environ.get("TMDB_API_KEY")
 TMDB_BASE_URL = "https://api.themoviedb.org/3"
 TMDB_IMAGE_URL = "https://image.tmdb.org/t/p/w500"
 
+# TMDB responses are reused for a while; search results change more often
+TMDB_CACHE_SIZE = 1024
+TMDB_SEARCH_TTL = 60 * 60
+TMDB_DETAILS_TTL = 24 * 60 * 60
+
+# Telegram Bot API HTTP pool (keep-alive connections shared by all handlers)
+TELEGRAM_POOL_SIZE = 32
+
 
 # ============== DATABASE ==============
 
-def get_db_connection():
+# The pool only keeps minconn connections idle and closes the rest on
+# return, so min = max keeps every connection (and its prepared
+# statements) alive instead of reconnecting under load
+DB_POOL_MAX_CONN = int(os.environ.get("DB_POOL_MAX_CONN", "20"))
+DB_POOL_MIN_CONN = DB_POOL_MAX_CONN
+
+# Set DB_SERVER_PREPARE=0 when DATABASE_URL points at PgBouncer in
+# transaction mode: PREPARE is session state and does not survive there
+DB_SERVER_PREPARE = os.environ.get("DB_SERVER_PREPARE", "1") != "0"
+
+db_pool: ThreadedConnectionPool | None = None
+
+
+def init_db_pool() -> None:
+    """Open the shared connection pool used by all DB helpers."""
+    global db_pool
     database_url = os.environ.get("DATABASE_URL")
     if not database_url:
         raise ValueError("DATABASE_URL not set")
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    db_pool = ThreadedConnectionPool(DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, database_url, cursor_factory=RealDictCursor)
+    atexit.register(db_pool.closeall)
+
+
+@contextmanager
+def db_cursor(modifies: int | None = None):
+    """Borrow a pooled connection and yield a cursor.
+    
+    Commits when the block exits normally, rolls back on error, and always
+    returns the connection to the pool. Pass the chat_id as `modifies` for
+    blocks that change a chat's movies, so cached renders for it are dropped
+    once the change is committed.
+    """
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            yield cur
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+    
+    if modifies is not None:
+        bump_chat_version(modifies)
+
+
+# Basket entries store list numbers; this numbers to_watch movies the same
+# way /list does so they can be joined to titles on the server.
+NUMBERED_TO_WATCH_SQL = """numbered AS (
+    SELECT id, title, row_number() OVER (ORDER BY added_at, id) AS n
+    FROM movies WHERE chat_id = $1 AND status = 'to_watch'
+)"""
+
+# Hot fixed queries, parsed and planned once per pooled connection.
+PREPARED_STATEMENTS = {
+    "add_movie": """WITH ins AS (
+                        INSERT INTO movies (chat_id, title, added_by, tmdb_id, year, rating, poster_path, genres)
+                        VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                        ON CONFLICT (chat_id, LOWER(title)) DO UPDATE SET title = movies.title
+                        RETURNING (xmax = 0) AS inserted, status
+                    )
+                    SELECT ins.inserted, ins.status,
+                           (SELECT COUNT(*) FROM movies WHERE chat_id = $1 AND status = 'to_watch')
+                           + ins.inserted::int AS to_watch
+                    FROM ins""",
+    "movie_by_id": "SELECT * FROM movies WHERE chat_id = $1 AND id = $2",
+    "watch_by_id": """WITH found AS (
+                          SELECT id, title, status FROM movies WHERE chat_id = $1 AND id = $2
+                      ), upd AS (
+                          UPDATE movies SET status = 'watched', watched_by = $3, watched_at = NOW()
+                          WHERE id IN (SELECT id FROM found WHERE status = 'to_watch')
+                          RETURNING id
+                      )
+                      SELECT found.title, u.updated,
+                             c.to_watch - u.updated AS to_watch, c.watched + u.updated AS watched
+                      FROM found, (SELECT COUNT(*) AS updated FROM upd) u, (
+                          SELECT COUNT(*) FILTER (WHERE status = 'to_watch') AS to_watch,
+                                 COUNT(*) FILTER (WHERE status = 'watched') AS watched
+                          FROM movies WHERE chat_id = $1
+                      ) c""",
+    "unwatch_by_id": """WITH found AS (
+                            SELECT id, title, status FROM movies WHERE chat_id = $1 AND id = $2
+                        ), upd AS (
+                            UPDATE movies SET status = 'to_watch', watched_by = NULL, watched_at = NULL
+                            WHERE id IN (SELECT id FROM found WHERE status = 'watched')
+                            RETURNING id
+                        )
+                        SELECT found.title, EXISTS (SELECT 1 FROM upd) AS updated FROM found""",
+    "remove_by_id": "DELETE FROM movies WHERE chat_id = $1 AND id = $2 RETURNING title",
+    "watch_by_number": f"""WITH {NUMBERED_TO_WATCH_SQL}, upd AS (
+                               UPDATE movies SET status = 'watched', watched_by = $3, watched_at = NOW()
+                               WHERE id = (SELECT id FROM numbered WHERE n = $2)
+                               RETURNING title
+                           )
+                           SELECT upd.title, c.to_watch - 1 AS to_watch, c.watched + 1 AS watched
+                           FROM upd, (
+                               SELECT COUNT(*) FILTER (WHERE status = 'to_watch') AS to_watch,
+                                      COUNT(*) FILTER (WHERE status = 'watched') AS watched
+                               FROM movies WHERE chat_id = $1
+                           ) c""",
+    "remove_by_number": f"""WITH {NUMBERED_TO_WATCH_SQL}
+                            DELETE FROM movies WHERE id = (SELECT id FROM numbered WHERE n = $2)
+                            RETURNING title""",
+    "movie_list": "SELECT id, title, year, rating FROM movies WHERE chat_id = $1 AND status = $2 ORDER BY added_at, id",
+    "movies_by_status": "SELECT * FROM movies WHERE chat_id = $1 AND status = $2 ORDER BY added_at, id",
+    "random_movie": """SELECT title, year, rating FROM movies
+                       WHERE chat_id = $1 AND status = 'to_watch' ORDER BY random() LIMIT 1""",
+    "add_to_basket": """WITH ins AS (
+                             INSERT INTO vote_basket (chat_id, user_id, user_name, movie_num)
+                             SELECT $1, $2, $3, unnest($4::int[])
+                             ON CONFLICT (chat_id, user_id, movie_num) DO NOTHING
+                             RETURNING movie_num
+                         )
+                         SELECT ARRAY(SELECT movie_num FROM ins) AS added""",
+    "user_basket": f"""WITH {NUMBERED_TO_WATCH_SQL}
+                       SELECT vb.movie_num, nm.title
+                       FROM vote_basket vb LEFT JOIN numbered nm ON nm.n = vb.movie_num
+                       WHERE vb.chat_id = $1 AND vb.user_id = $2
+                       ORDER BY vb.movie_num""",
+    "full_basket": f"""WITH {NUMBERED_TO_WATCH_SQL}
+                       SELECT vb.user_name, vb.movie_num, nm.title
+                       FROM vote_basket vb LEFT JOIN numbered nm ON nm.n = vb.movie_num
+                       WHERE vb.chat_id = $1
+                       ORDER BY vb.user_name, vb.movie_num""",
+    "random_numbered": f"""WITH {NUMBERED_TO_WATCH_SQL}
+                           SELECT nm.title FROM unnest($2::int[]) AS sel(n) JOIN numbered nm ON nm.n = sel.n
+                           ORDER BY random() LIMIT 1""",
+    "random_basket_title": f"""WITH {NUMBERED_TO_WATCH_SQL}
+                               SELECT EXISTS (SELECT 1 FROM vote_basket WHERE chat_id = $1) AS has_basket,
+                                      (SELECT title FROM numbered
+                                       WHERE n IN (SELECT movie_num FROM vote_basket WHERE chat_id = $1)
+                                       ORDER BY random() LIMIT 1) AS title""",
+    "unique_basket_titles": f"""WITH {NUMBERED_TO_WATCH_SQL}
+                                SELECT DISTINCT vb.movie_num, nm.id AS movie_id, nm.title
+                                FROM vote_basket vb LEFT JOIN numbered nm ON nm.n = vb.movie_num
+                                WHERE vb.chat_id = $1
+                                ORDER BY vb.movie_num""",
+}
+
+_prepared_on: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+# The same statements with $n turned into psycopg2 placeholders
+_inline_statements = {
+    name: re.sub(r"\$(\d+)", r"%(\1)s", sql) for name, sql in PREPARED_STATEMENTS.items()
+}
+
+
+def execute_prepared(cur, name: str, params: tuple) -> None:
+    """Run a statement from PREPARED_STATEMENTS, preparing it on first use.
+    
+    Prepared statements live for the session and survive rollbacks, so each
+    pooled connection only pays the parse/plan cost once per statement. With
+    DB_SERVER_PREPARE off the statement text is sent as a plain query.
+    """
+    if not DB_SERVER_PREPARE:
+        cur.execute(_inline_statements[name], {str(i): v for i, v in enumerate(params, 1)})
+        return
+    prepared = _prepared_on.setdefault(cur.connection, set())
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+        prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
 
 
 def init_db():
-    conn = get_db_connection()
+    init_db_pool()
+    conn = db_pool.getconn()
     cur = conn.cursor()
     
-    # Movies table with TMDB data
+    # Whole schema in one round-trip and one transaction
     cur.execute("""
+        -- Movies table with TMDB data
         CREATE TABLE IF NOT EXISTS movies (
             id SERIAL PRIMARY KEY,
             chat_id BIGINT NOT NULL,
@@ -70,22 +249,48 @@ def init_db():
             year INT,
             rating REAL,
             poster_path VARCHAR(255),
-            genres TEXT
-        )
-    """)
-    
-    cur.execute("""
+            genres INT[]
+        );
+        
+        -- Migrations, only touching the table (and taking its exclusive
+        -- lock) when an older schema is actually found
+        DO $$
+        BEGIN
+            -- Add new columns if they don't exist
+            IF (SELECT COUNT(*) FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'movies'
+                  AND column_name IN ('tmdb_id', 'year', 'rating', 'poster_path', 'genres')) < 5 THEN
+                ALTER TABLE movies
+                    ADD COLUMN IF NOT EXISTS tmdb_id INT,
+                    ADD COLUMN IF NOT EXISTS year INT,
+                    ADD COLUMN IF NOT EXISTS rating REAL,
+                    ADD COLUMN IF NOT EXISTS poster_path VARCHAR(255),
+                    ADD COLUMN IF NOT EXISTS genres INT[];
+            END IF;
+            
+            -- Genres used to be stored as comma-joined TEXT
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'movies'
+                  AND column_name = 'genres') = 'text' THEN
+                ALTER TABLE movies ALTER COLUMN genres TYPE INT[]
+                    USING string_to_array(NULLIF(genres, ''), ',')::INT[];
+            END IF;
+        END $$;
+        
         CREATE UNIQUE INDEX IF NOT EXISTS idx_movies_chat_title 
-        ON movies(chat_id, LOWER(title))
-    """)
-    
-    cur.execute("""
-        CREATE INDEX IF NOT EXISTS idx_movies_chat_status 
-        ON movies(chat_id, status)
-    """)
-    
-    # Vote basket
-    cur.execute("""
+        ON movies(chat_id, LOWER(title));
+        
+        -- Per-status lists in display order, no sort step; supersedes
+        -- the old (chat_id, status) index
+        CREATE INDEX IF NOT EXISTS idx_movies_chat_status_added 
+        ON movies(chat_id, status, added_at, id);
+        DROP INDEX IF EXISTS idx_movies_chat_status;
+        
+        -- Range scans for prefix title matches (LIKE 'search%')
+        CREATE INDEX IF NOT EXISTS idx_movies_chat_title_pat 
+        ON movies(chat_id, LOWER(title) text_pattern_ops);
+        
+        -- Vote basket
         CREATE TABLE IF NOT EXISTS vote_basket (
             id SERIAL PRIMARY KEY,
             chat_id BIGINT NOT NULL,
@@ -94,25 +299,47 @@ def init_db():
             movie_num INT NOT NULL,
             added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             UNIQUE(chat_id, user_id, movie_num)
-        )
-    """)
-    
-    cur.execute("""
+        );
+        
         CREATE INDEX IF NOT EXISTS idx_vote_basket_chat 
-        ON vote_basket(chat_id)
+        ON vote_basket(chat_id);
+        
+        -- Wheel
+        CREATE TABLE IF NOT EXISTS wheel_sessions (
+            session_id VARCHAR(255) PRIMARY KEY,
+            movies_data JSONB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP + INTERVAL '1 hour'
+        );
+        
+        CREATE TABLE IF NOT EXISTS wheel_history (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            movie_id INT NOT NULL,
+            movie_title VARCHAR(255),
+            winner_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        
+        CREATE INDEX IF NOT EXISTS idx_wheel_history_chat 
+        ON wheel_history(chat_id, winner_at);
     """)
     
-    # Add new columns if they don't exist (migration)
-    for col, col_type in [("tmdb_id", "INT"), ("year", "INT"), ("rating", "REAL"),
-                          ("poster_path", "VARCHAR(255)"), ("genres", "TEXT")]:
-        try:
-            cur.execute(f"ALTER TABLE movies ADD COLUMN {col} {col_type}")
-        except psycopg2.errors.DuplicateColumn:
-            conn.rollback()
-    
     conn.commit()
+    
+    # Trigram index for the LIKE '%...%' title fallback (needs pg_trgm)
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_movies_title_trgm 
+            ON movies USING gin (LOWER(title) gin_trgm_ops)
+        """)
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.warning(f"pg_trgm unavailable, title search stays unindexed: {e}")
+    
     cur.close()
-    conn.close()
+    db_pool.putconn(conn)
     logger.info("Database initialized")
 
 
@@ -126,8 +353,6 @@ def parse_movie_query(query: str) -> tuple[str, int | None]:
         "Начало (2010)" -> ("Начало", 2010)
         "The Matrix" -> ("The Matrix", None)
     """
-    import re
-    
     # Pattern 1: "Title (YYYY)"
     match = re.search(r'^(.+?)\s*\((\d{4})\)\s*$', query)
     if match:
@@ -145,6 +370,52 @@ def parse_movie_query(query: str) -> tuple[str, int | None]:
     return query.strip(), None
 
 
+# One keep-alive client for all TMDB calls; closed in post_shutdown
+tmdb_client = httpx.AsyncClient(
+    base_url=TMDB_BASE_URL,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+)
+
+_tmdb_cache: OrderedDict[tuple, tuple[float, dict]] = OrderedDict()
+_tmdb_inflight: dict[tuple, asyncio.Task] = {}
+
+
+async def tmdb_get(path: str, params: dict, ttl: float) -> dict | None:
+    """GET a TMDB endpoint, reusing a cached response younger than `ttl` seconds.
+    
+    Concurrent misses for the same request share one HTTP call. Returns the
+    decoded JSON, or None on a non-200 response. Cached data is shared
+    between callers and must not be modified.
+    """
+    key = (path, tuple(sorted(params.items())))
+    cached = _tmdb_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        _tmdb_cache.move_to_end(key)
+        return cached[1]
+    
+    task = _tmdb_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_tmdb_fetch(key, path, params, ttl))
+        _tmdb_inflight[key] = task
+        task.add_done_callback(lambda _: _tmdb_inflight.pop(key, None))
+    # A cancelled caller must not cancel the fetch for everyone else
+    return await asyncio.shield(task)
+
+
+async def _tmdb_fetch(key: tuple, path: str, params: dict, ttl: float) -> dict | None:
+    resp = await tmdb_client.get(path, params={"api_key": TMDB_API_KEY, **params})
+    if resp.status_code != 200:
+        return None
+    
+    data = resp.json()
+    _tmdb_cache[key] = (time.monotonic() + ttl, data)
+    _tmdb_cache.move_to_end(key)
+    if len(_tmdb_cache) > TMDB_CACHE_SIZE:
+        _tmdb_cache.popitem(last=False)
+    return data
+
+
 async def tmdb_search(query: str, page: int = 1, year: int | None = None) -> dict:
     """Search TMDB for movies with pagination and year filter.
     
@@ -159,7 +430,6 @@ async def tmdb_search(query: str, page: int = 1, year: int | None = None) -> dic
     async def search_tmdb(search_query: str, lang: str) -> dict:
         """Helper to search TMDB with specific language."""
         params = {
-            "api_key": TMDB_API_KEY,
             "query": search_query,
             "language": lang,
             "page": page
@@ -167,15 +437,12 @@ async def tmdb_search(query: str, page: int = 1, year: int | None = None) -> dic
         if year:
             params["year"] = year
         
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f"{TMDB_BASE_URL}/search/movie", params=params)
-            if resp.status_code == 200:
-                return resp.json()
-        return {"results": [], "total_pages": 0, "page": 1}
+        data = await tmdb_get("/search/movie", params, TMDB_SEARCH_TTL)
+        return data or {"results": [], "total_pages": 0, "page": 1}
     
-    # Search in Russian first
+    # Search in Russian first (copy: the cached response must stay untouched)
     data_ru = await search_tmdb(query, "ru-RU")
-    results = data_ru.get("results", [])
+    results = list(data_ru.get("results", []))
     
     # If few results, try English as well
     if len(results) < 5:
@@ -223,14 +490,7 @@ async def tmdb_get_movie(tmdb_id: int) -> dict | None:
     if not TMDB_API_KEY:
         return None
     
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{TMDB_BASE_URL}/movie/{tmdb_id}",
-            params={"api_key": TMDB_API_KEY, "language": "ru-RU"}
-        )
-        if resp.status_code == 200:
-            return resp.json()
-    return None
+    return await tmdb_get(f"/movie/{tmdb_id}", {"language": "ru-RU"}, TMDB_DETAILS_TTL)
 
 
 async def tmdb_get_recommendations(tmdb_id: int) -> list[dict]:
@@ -238,14 +498,9 @@ async def tmdb_get_recommendations(tmdb_id: int) -> list[dict]:
     if not TMDB_API_KEY:
         return []
     
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{TMDB_BASE_URL}/movie/{tmdb_id}/recommendations",
-            params={"api_key": TMDB_API_KEY, "language": "ru-RU"}
-        )
-        if resp.status_code == 200:
-            data = resp.json()
-            return data.get("results", [])[:10]
+    data = await tmdb_get(f"/movie/{tmdb_id}/recommendations", {"language": "ru-RU"}, TMDB_DETAILS_TTL)
+    if data:
+        return data.get("results", [])[:10]
     return []
 
 
@@ -254,424 +509,487 @@ async def tmdb_discover_by_genres(genre_ids: list[int], exclude_ids: list[int] =
     if not TMDB_API_KEY:
         return []
     
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{TMDB_BASE_URL}/discover/movie",
-            params={
-                "api_key": TMDB_API_KEY,
-                "language": "ru-RU",
-                "with_genres": ",".join(map(str, genre_ids)),
-                "sort_by": "vote_average.desc",
-                "vote_count.gte": 100
-            }
-        )
-        if resp.status_code == 200:
-            data = resp.json()
-            results = data.get("results", [])
-            if exclude_ids:
-                results = [m for m in results if m["id"] not in exclude_ids]
-            return results[:10]
+    data = await tmdb_get(
+        "/discover/movie",
+        {
+            "language": "ru-RU",
+            "with_genres": ",".join(map(str, genre_ids)),
+            "sort_by": "vote_average.desc",
+            "vote_count.gte": 100
+        },
+        TMDB_SEARCH_TTL
+    )
+    if data:
+        results = data.get("results", [])
+        if exclude_ids:
+            results = [m for m in results if m["id"] not in exclude_ids]
+        return results[:10]
     return []
 
 
+# ============== CACHE ==============
+
+# Every mutation of a chat's movies stamps the chat with a fresh version;
+# cached renders remember the version they were built from.
+_version_counter = itertools.count(1)
+_chat_versions: dict[int, int] = {}
+
+LIST_PAGE_CACHE_SIZE = 512
+_list_page_cache: OrderedDict[tuple, tuple[int, tuple]] = OrderedDict()
+
+WATCHED_PAGE_CACHE_SIZE = 512
+_watched_page_cache: OrderedDict[tuple, tuple[int, tuple]] = OrderedDict()
+
+# Telegram file_id of each poster once uploaded, so resends skip the download
+POSTER_FILE_ID_CACHE_SIZE = 1024
+_poster_file_ids: OrderedDict[str, str] = OrderedDict()
+
+MOVIE_LIST_CACHE_SIZE = 1000
+_movie_list_cache: OrderedDict[tuple, tuple[int, list]] = OrderedDict()
+
+_cache_lock = threading.Lock()
+
+
+def bump_chat_version(chat_id: int) -> None:
+    _chat_versions[chat_id] = next(_version_counter)
+
+
+def chat_version(chat_id: int) -> int:
+    return _chat_versions.get(chat_id, 0)
+
+
+def cache_get(cache: OrderedDict, key: tuple, version: int):
+    """Return the cached value for key if it was built at `version`, else None."""
+    with _cache_lock:
+        cached = cache.get(key)
+        if cached and cached[0] == version:
+            cache.move_to_end(key)
+            return cached[1]
+    return None
+
+
+def cache_put(cache: OrderedDict, key: tuple, version: int, value, max_size: int) -> None:
+    """Store value for key, evicting the least recently used entry when full."""
+    with _cache_lock:
+        cache[key] = (version, value)
+        cache.move_to_end(key)
+        if len(cache) > max_size:
+            cache.popitem(last=False)
+
+
 # ============== DB FUNCTIONS ==============
 
 def add_movie_db(chat_id: int, title: str, added_by: str,
                  tmdb_id: int = None, year: int = None, rating: float = None,
-                 poster_path: str = None, genres: str = None) -> tuple[bool, str]:
-    conn = get_db_connection()
-    cur = conn.cursor()
+                 poster_path: str = None, genres: list[int] = None) -> tuple[bool, str, int | None]:
+    """Insert a movie.
     
-    try:
-        cur.execute(
-            """INSERT INTO movies (chat_id, title, added_by, tmdb_id, year, rating, poster_path, genres) 
-               VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+    Returns (added, status, to_watch_count). A duplicate title is a no-op
+    upsert, so its status comes back from the same statement; the count is
+    None in that case.
+    """
+    with db_cursor(modifies=chat_id) as cur:
+        execute_prepared(
+            cur, "add_movie",
             (chat_id, title, added_by, tmdb_id, year, rating, poster_path, genres)
         )
-        conn.commit()
-        return True, "added"
-    except psycopg2.errors.UniqueViolation:
-        conn.rollback()
+        row = cur.fetchone()
+    
+    if row["inserted"]:
+        return True, "added", row["to_watch"]
+    return False, row["status"], None
+
+
+def add_movies_db(chat_id: int, titles: list[str], added_by: str) -> tuple[list[str], list[str], int]:
+    """Insert several titles in one statement.
+    
+    Returns (added, skipped, to_watch_count) with titles in input order;
+    titles already in the list, or repeated within `titles`, are skipped.
+    """
+    with db_cursor(modifies=chat_id) as cur:
         cur.execute(
-            "SELECT status FROM movies WHERE chat_id = %s AND LOWER(title) = LOWER(%s)",
-            (chat_id, title)
+            """WITH ins AS (
+                   INSERT INTO movies (chat_id, title, added_by)
+                   SELECT %s, t.title, %s FROM unnest(%s::text[]) WITH ORDINALITY AS t(title, n)
+                   ORDER BY t.n
+                   ON CONFLICT (chat_id, LOWER(title)) DO NOTHING
+                   RETURNING title
+               )
+               SELECT ARRAY(SELECT title FROM ins) AS titles,
+                      (SELECT COUNT(*) FROM movies WHERE chat_id = %s AND status = 'to_watch')
+                      + (SELECT COUNT(*) FROM ins) AS to_watch""",
+            (chat_id, added_by, titles, chat_id)
         )
         row = cur.fetchone()
-        return False, row["status"] if row else "exists"
-    finally:
-        cur.close()
-        conn.close()
+    
+    inserted = Counter(row["titles"])
+    added = []
+    skipped = []
+    for title in titles:
+        if inserted[title]:
+            inserted[title] -= 1
+            added.append(title)
+        else:
+            skipped.append(title)
+    return added, skipped, row["to_watch"]
 
 
 def get_movie_by_id(chat_id: int, movie_id: int) -> dict | None:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM movies WHERE chat_id = %s AND id = %s", (chat_id, movie_id))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    return row
+    with db_cursor() as cur:
+        execute_prepared(cur, "movie_by_id", (chat_id, movie_id))
+        return cur.fetchone()
 
 
-def mark_watched_by_id(chat_id: int, movie_id: int, watched_by: str) -> tuple[bool, str | None]:
-    conn = get_db_connection()
-    cur = conn.cursor()
+def mark_watched_by_id(chat_id: int, movie_id: int, watched_by: str) -> tuple[bool, str | None, dict | None]:
+    """Mark a movie watched.
     
-    cur.execute("SELECT id, title, status FROM movies WHERE chat_id = %s AND id = %s", (chat_id, movie_id))
-    row = cur.fetchone()
+    Returns (success, title, counts); counts reflect the update and are
+    computed in the same statement, None when nothing was updated.
+    """
+    with db_cursor(modifies=chat_id) as cur:
+        execute_prepared(cur, "watch_by_id", (chat_id, movie_id, watched_by))
+        row = cur.fetchone()
     
     if not row:
-        cur.close()
-        conn.close()
-        return False, None
-    
-    if row["status"] == "watched":
-        cur.close()
-        conn.close()
-        return False, row["title"]
-    
-    cur.execute(
-        "UPDATE movies SET status = 'watched', watched_by = %s, watched_at = %s WHERE id = %s",
-        (watched_by, datetime.now(), row["id"])
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
-    return True, row["title"]
+        return False, None, None
+    if not row["updated"]:
+        return False, row["title"], None
+    return True, row["title"], {"to_watch": row["to_watch"], "watched": row["watched"]}
 
 
 def unwatch_movie_by_id(chat_id: int, movie_id: int) -> tuple[bool, str | None]:
     """Move a watched movie back to to_watch list."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute("SELECT id, title, status FROM movies WHERE chat_id = %s AND id = %s", (chat_id, movie_id))
-    row = cur.fetchone()
+    with db_cursor(modifies=chat_id) as cur:
+        execute_prepared(cur, "unwatch_by_id", (chat_id, movie_id))
+        row = cur.fetchone()
     
     if not row:
-        cur.close()
-        conn.close()
         return False, None
-    
-    if row["status"] != "watched":
-        cur.close()
-        conn.close()
-        return False, row["title"]
-    
-    cur.execute(
-        "UPDATE movies SET status = 'to_watch', watched_by = NULL, watched_at = NULL WHERE id = %s",
-        (row["id"],)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
-    return True, row["title"]
+    return row["updated"], row["title"]
 
 
 def update_movie_tmdb_data(chat_id: int, movie_id: int, tmdb_id: int, year: int = None,
-                           rating: float = None, poster_path: str = None, genres: str = None) -> bool:
+                           rating: float = None, poster_path: str = None, genres: list[int] = None) -> bool:
     """Update movie with TMDB data."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute(
-        """UPDATE movies 
-           SET tmdb_id = %s, year = %s, rating = %s, poster_path = %s, genres = %s 
-           WHERE chat_id = %s AND id = %s""",
-        (tmdb_id, year, rating, poster_path, genres, chat_id, movie_id)
-    )
-    conn.commit()
-    success = cur.rowcount > 0
-    cur.close()
-    conn.close()
-    return success
+    with db_cursor(modifies=chat_id) as cur:
+        cur.execute(
+            """UPDATE movies 
+               SET tmdb_id = %s, year = %s, rating = %s, poster_path = %s, genres = %s 
+               WHERE chat_id = %s AND id = %s""",
+            (tmdb_id, year, rating, poster_path, genres, chat_id, movie_id)
+        )
+        return cur.rowcount > 0
 
 
 def rename_movie_by_id(chat_id: int, movie_id: int, new_title: str) -> tuple[bool, str | None]:
     """Rename a movie."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute("SELECT id, title FROM movies WHERE chat_id = %s AND id = %s", (chat_id, movie_id))
-    row = cur.fetchone()
-    
-    if not row:
-        cur.close()
-        conn.close()
-        return False, None
-    
-    old_title = row["title"]
-    
-    try:
-        cur.execute(
-            "UPDATE movies SET title = %s WHERE chat_id = %s AND id = %s",
-            (new_title, chat_id, movie_id)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        return True, old_title
-    except psycopg2.errors.UniqueViolation:
-        conn.rollback()
-        cur.close()
-        conn.close()
-        return False, old_title
+    with db_cursor(modifies=chat_id) as cur:
+        try:
+            # Self-join so RETURNING sees the title from before the update
+            cur.execute(
+                """UPDATE movies m SET title = %s
+                   FROM movies old
+                   WHERE old.id = m.id AND m.chat_id = %s AND m.id = %s
+                   RETURNING old.title""",
+                (new_title, chat_id, movie_id)
+            )
+            row = cur.fetchone()
+            return (True, row["title"]) if row else (False, None)
+        except psycopg2.errors.UniqueViolation:
+            cur.connection.rollback()
+            cur.execute("SELECT title FROM movies WHERE chat_id = %s AND id = %s", (chat_id, movie_id))
+            return False, cur.fetchone()["title"]
 
 
 def remove_movie_by_id(chat_id: int, movie_id: int) -> str | None:
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_cursor(modifies=chat_id) as cur:
+        execute_prepared(cur, "remove_by_id", (chat_id, movie_id))
+        row = cur.fetchone()
     
-    cur.execute("SELECT title FROM movies WHERE chat_id = %s AND id = %s", (chat_id, movie_id))
-    row = cur.fetchone()
+    return row["title"] if row else None
+
+
+def mark_watched_by_number(chat_id: int, num: int, watched_by: str) -> tuple[str | None, dict | None]:
+    """Mark the movie at /list position `num` watched.
     
-    if not row:
-        cur.close()
-        conn.close()
-        return None
+    Returns (title, counts), or (None, None) when there is no such position.
+    """
+    with db_cursor(modifies=chat_id) as cur:
+        execute_prepared(cur, "watch_by_number", (chat_id, num, watched_by))
+        row = cur.fetchone()
     
-    cur.execute("DELETE FROM movies WHERE id = %s", (movie_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
-    return row["title"]
+    if not row:
+        return None, None
+    return row["title"], {"to_watch": row["to_watch"], "watched": row["watched"]}
 
 
-def mark_watched_db(chat_id: int, search: str, watched_by: str) -> tuple[bool, str | None]:
-    conn = get_db_connection()
-    cur = conn.cursor()
+def remove_movie_by_number(chat_id: int, num: int) -> str | None:
+    """Delete the movie at /list position `num`; returns its title."""
+    with db_cursor(modifies=chat_id) as cur:
+        execute_prepared(cur, "remove_by_number", (chat_id, num))
+        row = cur.fetchone()
     
-    cur.execute(
-        "SELECT id, title, status FROM movies WHERE chat_id = %s AND LOWER(title) = LOWER(%s)",
-        (chat_id, search)
-    )
-    row = cur.fetchone()
+    return row["title"] if row else None
+
+
+def mark_watched_db(chat_id: int, search: str, watched_by: str) -> tuple[bool, str | None, dict | None]:
+    """Mark a movie watched by exact title, else by prefix, else partial to_watch match.
     
-    if not row:
+    Within a tier the shortest title wins, i.e. the one the search covers
+    best. Lookup, update and the resulting counts are a single statement. An
+    exact match that is already watched comes back as (False, title, None).
+    """
+    with db_cursor(modifies=chat_id) as cur:
         cur.execute(
-            "SELECT id, title, status FROM movies WHERE chat_id = %s AND LOWER(title) LIKE LOWER(%s) AND status = 'to_watch' LIMIT 1",
-            (chat_id, f"%{search}%")
+            """WITH found AS (
+                   SELECT id, title, status FROM (
+                       (SELECT id, title, status, 3 AS rank FROM movies
+                        WHERE chat_id = %s AND LOWER(title) = LOWER(%s))
+                       UNION ALL
+                       (SELECT id, title, status, 2 FROM movies
+                        WHERE chat_id = %s AND LOWER(title) LIKE LOWER(%s) AND status = 'to_watch')
+                       UNION ALL
+                       (SELECT id, title, status, 1 FROM movies
+                        WHERE chat_id = %s AND LOWER(title) LIKE LOWER(%s) AND status = 'to_watch')
+                   ) t
+                   ORDER BY rank DESC, LENGTH(title)
+                   LIMIT 1
+               ), upd AS (
+                   UPDATE movies SET status = 'watched', watched_by = %s, watched_at = NOW()
+                   WHERE id IN (SELECT id FROM found WHERE status = 'to_watch')
+                   RETURNING id
+               )
+               SELECT found.title, u.updated,
+                      c.to_watch - u.updated AS to_watch, c.watched + u.updated AS watched
+               FROM found, (SELECT COUNT(*) AS updated FROM upd) u, (
+                   SELECT COUNT(*) FILTER (WHERE status = 'to_watch') AS to_watch,
+                          COUNT(*) FILTER (WHERE status = 'watched') AS watched
+                   FROM movies WHERE chat_id = %s
+               ) c""",
+            (chat_id, search, chat_id, f"{search}%", chat_id, f"%{search}%", watched_by, chat_id)
         )
         row = cur.fetchone()
     
     if not row:
-        cur.close()
-        conn.close()
-        return False, None
-    
-    if row["status"] == "watched":
-        cur.close()
-        conn.close()
-        return False, row["title"]
-    
-    cur.execute(
-        "UPDATE movies SET status = 'watched', watched_by = %s, watched_at = %s WHERE id = %s",
-        (watched_by, datetime.now(), row["id"])
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
-    return True, row["title"]
+        return False, None, None
+    if not row["updated"]:
+        return False, row["title"], None
+    return True, row["title"], {"to_watch": row["to_watch"], "watched": row["watched"]}
 
 
 def remove_movie_db(chat_id: int, search: str) -> str | None:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute("SELECT id, title FROM movies WHERE chat_id = %s AND LOWER(title) = LOWER(%s)", (chat_id, search))
-    row = cur.fetchone()
-    
-    if not row:
-        cur.execute("SELECT id, title FROM movies WHERE chat_id = %s AND LOWER(title) LIKE LOWER(%s) LIMIT 1", (chat_id, f"%{search}%"))
+    with db_cursor(modifies=chat_id) as cur:
+        cur.execute(
+            """DELETE FROM movies WHERE id = (
+                   SELECT id FROM (
+                       (SELECT id, title, 3 AS rank FROM movies
+                        WHERE chat_id = %s AND LOWER(title) = LOWER(%s))
+                       UNION ALL
+                       (SELECT id, title, 2 FROM movies
+                        WHERE chat_id = %s AND LOWER(title) LIKE LOWER(%s))
+                       UNION ALL
+                       (SELECT id, title, 1 FROM movies
+                        WHERE chat_id = %s AND LOWER(title) LIKE LOWER(%s))
+                   ) t
+                   ORDER BY rank DESC, LENGTH(title)
+                   LIMIT 1
+               )
+               RETURNING title""",
+            (chat_id, search, chat_id, f"{search}%", chat_id, f"%{search}%")
+        )
         row = cur.fetchone()
     
-    if not row:
-        cur.close()
-        conn.close()
-        return None
-    
-    cur.execute("DELETE FROM movies WHERE id = %s", (row["id"],))
-    conn.commit()
-    cur.close()
-    conn.close()
-    return row["title"]
+    return row["title"] if row else None
 
 
-def get_movies_db(chat_id: int, status: str | None = None) -> list[dict]:
-    conn = get_db_connection()
-    cur = conn.cursor()
+def get_movies_db(chat_id: int, status: str) -> list[dict]:
+    with db_cursor() as cur:
+        execute_prepared(cur, "movies_by_status", (chat_id, status))
+        return cur.fetchall()
+
+
+def get_all_movies_db(chat_id: int) -> tuple[list[dict], list[dict]]:
+    """Full rows of a chat's to_watch and watched movies, in that order.
     
-    if status:
-        cur.execute("SELECT * FROM movies WHERE chat_id = %s AND status = %s ORDER BY added_at", (chat_id, status))
-    else:
-        cur.execute("SELECT * FROM movies WHERE chat_id = %s ORDER BY status DESC, added_at", (chat_id,))
+    Each status is read with its own (chat_id, status) index scan, so the
+    rows arrive already split.
+    """
+    with db_cursor() as cur:
+        execute_prepared(cur, "movies_by_status", (chat_id, "to_watch"))
+        to_watch = cur.fetchall()
+        execute_prepared(cur, "movies_by_status", (chat_id, "watched"))
+        watched = cur.fetchall()
     
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
+    return to_watch, watched
 
 
-def get_counts_db(chat_id: int) -> dict:
-    conn = get_db_connection()
-    cur = conn.cursor()
+def get_movie_list_db(chat_id: int, status: str) -> list[dict]:
+    """Like get_movies_db, but only the columns lists and number lookups use.
     
-    cur.execute("SELECT status, COUNT(*) as count FROM movies WHERE chat_id = %s GROUP BY status", (chat_id,))
+    Results are cached until the chat's movies change; callers share the
+    returned list and must not modify it.
+    """
+    key = (chat_id, status)
+    version = chat_version(chat_id)
+    cached = cache_get(_movie_list_cache, key, version)
+    if cached is not None:
+        return cached
     
-    counts = {"to_watch": 0, "watched": 0}
-    for row in cur.fetchall():
-        counts[row["status"]] = row["count"]
+    with db_cursor() as cur:
+        execute_prepared(cur, "movie_list", (chat_id, status))
+        movies = cur.fetchall()
     
-    cur.close()
-    conn.close()
-    return counts
+    cache_put(_movie_list_cache, key, version, movies, MOVIE_LIST_CACHE_SIZE)
+    return movies
+
+
+def pick_random_movie_db(chat_id: int) -> dict | None:
+    """Pick one random to_watch movie on the server side."""
+    with db_cursor() as cur:
+        execute_prepared(cur, "random_movie", (chat_id,))
+        return cur.fetchone()
+
+
+def sample_to_watch_db(chat_id: int, num: int) -> list[str]:
+    """Pick up to `num` random to_watch titles on the server side."""
+    with db_cursor() as cur:
+        cur.execute(
+            "SELECT title FROM movies WHERE chat_id = %s AND status = 'to_watch' ORDER BY random() LIMIT %s",
+            (chat_id, num)
+        )
+        return [row["title"] for row in cur.fetchall()]
+
+
+def pick_random_numbered_db(chat_id: int, nums: list[int]) -> str | None:
+    """Pick a random to_watch title among the given list numbers; repeats weight the pick."""
+    with db_cursor() as cur:
+        execute_prepared(cur, "random_numbered", (chat_id, nums))
+        row = cur.fetchone()
+    return row["title"] if row else None
 
 
 def get_watched_genres(chat_id: int) -> list[int]:
     """Get most common genres from watched movies."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute("SELECT genres FROM movies WHERE chat_id = %s AND status = 'watched' AND genres IS NOT NULL", (chat_id,))
-    rows = cur.fetchall()
-    
-    cur.close()
-    conn.close()
-    
-    genre_count = {}
-    for row in rows:
-        if row["genres"]:
-            for g in row["genres"].split(","):
-                g = g.strip()
-                if g.isdigit():
-                    gid = int(g)
-                    genre_count[gid] = genre_count.get(gid, 0) + 1
-    
-    # Return top 3 genres
-    sorted_genres = sorted(genre_count.items(), key=lambda x: x[1], reverse=True)
-    return [g[0] for g in sorted_genres[:3]]
+    with db_cursor() as cur:
+        # Top 3 genres, counted on the server
+        cur.execute(
+            """SELECT g AS gid, COUNT(*) AS cnt
+               FROM movies, unnest(genres) AS g
+               WHERE chat_id = %s AND status = 'watched'
+               GROUP BY gid
+               ORDER BY cnt DESC, gid
+               LIMIT 3""",
+            (chat_id,)
+        )
+        return [row["gid"] for row in cur.fetchall()]
 
 
 def get_watched_tmdb_ids(chat_id: int) -> list[int]:
     """Get TMDB IDs of watched movies."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute("SELECT tmdb_id FROM movies WHERE chat_id = %s AND tmdb_id IS NOT NULL", (chat_id,))
-    rows = cur.fetchall()
-    
-    cur.close()
-    conn.close()
-    
-    return [row["tmdb_id"] for row in rows]
+    # One array row instead of a dict per id
+    with db_cursor() as cur:
+        cur.execute(
+            "SELECT ARRAY(SELECT tmdb_id FROM movies WHERE chat_id = %s AND tmdb_id IS NOT NULL) AS ids",
+            (chat_id,)
+        )
+        return cur.fetchone()["ids"]
 
 
 # ============== VOTE BASKET ==============
 
 def add_to_basket(chat_id: int, user_id: int, user_name: str, movie_nums: list[int]) -> tuple[list[int], list[int]]:
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_cursor() as cur:
+        execute_prepared(cur, "add_to_basket", (chat_id, user_id, user_name, movie_nums))
+        inserted = Counter(cur.fetchone()["added"])
     
     added = []
     exists = []
-    
     for num in movie_nums:
-        try:
-            cur.execute(
-                "INSERT INTO vote_basket (chat_id, user_id, user_name, movie_num) VALUES (%s, %s, %s, %s)",
-                (chat_id, user_id, user_name, num)
-            )
-            conn.commit()
+        if inserted[num]:
+            inserted[num] -= 1
             added.append(num)
-        except psycopg2.errors.UniqueViolation:
-            conn.rollback()
+        else:
             exists.append(num)
     
-    cur.close()
-    conn.close()
     return added, exists
 
 
 def remove_from_basket(chat_id: int, user_id: int, movie_nums: list[int] | None = None) -> int:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    if movie_nums is None:
-        cur.execute("DELETE FROM vote_basket WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
-    else:
-        cur.execute("DELETE FROM vote_basket WHERE chat_id = %s AND user_id = %s AND movie_num = ANY(%s)", (chat_id, user_id, movie_nums))
-    
-    count = cur.rowcount
-    conn.commit()
-    cur.close()
-    conn.close()
-    return count
+    with db_cursor() as cur:
+        if movie_nums is None:
+            cur.execute("DELETE FROM vote_basket WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
+        else:
+            cur.execute("DELETE FROM vote_basket WHERE chat_id = %s AND user_id = %s AND movie_num = ANY(%s)", (chat_id, user_id, movie_nums))
+        
+        return cur.rowcount
 
 
 def clear_basket(chat_id: int) -> int:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM vote_basket WHERE chat_id = %s", (chat_id,))
-    count = cur.rowcount
-    conn.commit()
-    cur.close()
-    conn.close()
-    return count
+    with db_cursor() as cur:
+        cur.execute("DELETE FROM vote_basket WHERE chat_id = %s", (chat_id,))
+        return cur.rowcount
 
 
-def get_user_basket(chat_id: int, user_id: int) -> list[int]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT movie_num FROM vote_basket WHERE chat_id = %s AND user_id = %s ORDER BY movie_num", (chat_id, user_id))
-    nums = [row["movie_num"] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return nums
+def get_user_basket_with_titles(chat_id: int, user_id: int) -> list[dict]:
+    """The user's basket as movie_num/title rows; stale numbers have title None."""
+    with db_cursor() as cur:
+        execute_prepared(cur, "user_basket", (chat_id, user_id))
+        return cur.fetchall()
 
 
-def get_full_basket(chat_id: int) -> list[dict]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, user_name, movie_num FROM vote_basket WHERE chat_id = %s ORDER BY user_name, movie_num", (chat_id,))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
+def get_full_basket_with_titles(chat_id: int) -> list[dict]:
+    """Every basket entry as user_name/movie_num/title rows; stale numbers have title None."""
+    with db_cursor() as cur:
+        execute_prepared(cur, "full_basket", (chat_id,))
+        return cur.fetchall()
 
 
-def get_unique_basket_movies(chat_id: int) -> list[int]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT movie_num FROM vote_basket WHERE chat_id = %s ORDER BY movie_num", (chat_id,))
-    nums = [row["movie_num"] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return nums
+def get_unique_basket_titles(chat_id: int) -> list[dict]:
+    """Distinct basket numbers as movie_num/movie_id/title rows; stale numbers have title None."""
+    with db_cursor() as cur:
+        execute_prepared(cur, "unique_basket_titles", (chat_id,))
+        return cur.fetchall()
+
+
+def pick_random_basket_title(chat_id: int) -> tuple[bool, str | None]:
+    """Pick a random title among distinct basket numbers.
+    
+    Returns (has_basket, title); title is None when the basket is empty or
+    none of its numbers are on the list any more.
+    """
+    with db_cursor() as cur:
+        execute_prepared(cur, "random_basket_title", (chat_id,))
+        row = cur.fetchone()
+    return row["has_basket"], row["title"]
 
 
 # ============== HELPERS ==============
 
+NUMBER_SEPARATORS = str.maketrans(",;|", "   ")
+
+# List numbers are bound as SQL integers; anything larger can't be a position
+MAX_LIST_NUMBER = 2**31 - 1
+
+
+def parse_numbers(text: str) -> list[int] | None:
+    """Parse "1,5 12" style movie numbers; None if any token is not a number."""
+    try:
+        return list(map(int, text.translate(NUMBER_SEPARATORS).split()))
+    except ValueError:
+        return None
+
+
 def format_movie(movie: dict, idx: int = None) -> str:
     """Format movie for display."""
-    parts = []
-    if idx:
-        parts.append(f"{idx}.")
-    
-    parts.append(movie["title"])
-    
-    if movie.get("year"):
-        parts.append(f"({movie['year']})")
-    
-    if movie.get("rating"):
-        parts.append(f"⭐{movie['rating']:.1f}")
-    
-    return " ".join(parts)
+    prefix = f"{idx}. " if idx else ""
+    year = f" ({movie['year']})" if movie.get("year") else ""
+    rating = f" ⭐{movie['rating']:.1f}" if movie.get("rating") else ""
+    return f"{prefix}{movie['title']}{year}{rating}"
 
 
 # ============== BOT COMMANDS ==============
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    welcome_text = """
+WELCOME_TEXT = """
 🎬 *Movie Watchlist Bot*
 
 *Основные:*
@@ -715,7 +1033,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 `/export` — экспорт .txt
 `/export -csv` — экспорт .csv
 """
-    await update.message.reply_text(welcome_text, parse_mode="Markdown")
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(WELCOME_TEXT, parse_mode="Markdown")
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -749,15 +1070,7 @@ async def add_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
         
         # Batch add without TMDB
-        added = []
-        skipped = []
-        
-        for title in movies:
-            success, _ = add_movie_db(chat_id, title, added_by)
-            if success:
-                added.append(title)
-            else:
-                skipped.append(title)
+        added, skipped, to_watch_count = await asyncio.to_thread(add_movies_db, chat_id, movies, added_by)
         
         parts = []
         if added:
@@ -770,8 +1083,7 @@ async def add_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if skipped:
             parts.append(f"\n⚠️ Уже в списке ({len(skipped)})")
         
-        counts = get_counts_db(chat_id)
-        parts.append(f"\n📋 Всего к просмотру: {counts['to_watch']}")
+        parts.append(f"\n📋 Всего к просмотру: {to_watch_count}")
         
         await update.message.reply_text("\n".join(parts))
         return
@@ -797,11 +1109,10 @@ async def add_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
     
     # No TMDB or no results - add directly
-    success, status = add_movie_db(chat_id, query, added_by)
+    success, status, to_watch_count = await asyncio.to_thread(add_movie_db, chat_id, query, added_by)
     
     if success:
-        counts = get_counts_db(chat_id)
-        await update.message.reply_text(f"✅ *{query}* добавлен\n📋 К просмотру: {counts['to_watch']}", parse_mode="Markdown")
+        await update.message.reply_text(f"✅ *{query}* добавлен\n📋 К просмотру: {to_watch_count}", parse_mode="Markdown")
     else:
         await update.message.reply_text(f"⚠️ *{query}* уже в списке!", parse_mode="Markdown")
 
@@ -926,28 +1237,31 @@ async def tmdb_add_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if data.startswith("tmdb_add_"):
         tmdb_id = data.replace("tmdb_add_", "")
         movie = context.user_data.get("tmdb_results", {}).get(tmdb_id)
+        if not movie:
+            # Results shown to another user, or before a restart
+            movie = await tmdb_get_movie(int(tmdb_id))
         
         if movie:
             title = movie.get("title", "Unknown")
             year = int(movie.get("release_date", "0000")[:4]) if movie.get("release_date") else None
             rating = movie.get("vote_average")
             poster_path = movie.get("poster_path")
-            genres = ",".join(map(str, movie.get("genre_ids", [])))
+            # Search results carry genre_ids, the details endpoint full genres
+            genres = movie.get("genre_ids") or [g["id"] for g in movie.get("genres", [])]
             
-            success, status = add_movie_db(
-                chat_id, title, added_by,
+            success, status, to_watch_count = await asyncio.to_thread(
+                add_movie_db, chat_id, title, added_by,
                 tmdb_id=int(tmdb_id), year=year, rating=rating,
                 poster_path=poster_path, genres=genres
             )
             
             if success:
-                counts = get_counts_db(chat_id)
                 text = f"✅ *{title}*"
                 if year:
                     text += f" ({year})"
                 if rating:
                     text += f" ⭐{rating:.1f}"
-                text += f"\n📋 К просмотру: {counts['to_watch']}"
+                text += f"\n📋 К просмотру: {to_watch_count}"
                 await query.edit_message_text(text, parse_mode="Markdown")
             else:
                 await query.edit_message_text(f"⚠️ *{title}* уже в списке!", parse_mode="Markdown")
@@ -956,11 +1270,10 @@ async def tmdb_add_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     elif data.startswith("add_manual_"):
         title = data.replace("add_manual_", "")
-        success, status = add_movie_db(chat_id, title, added_by)
+        success, status, to_watch_count = await asyncio.to_thread(add_movie_db, chat_id, title, added_by)
         
         if success:
-            counts = get_counts_db(chat_id)
-            await query.edit_message_text(f"✅ *{title}* добавлен\n📋 К просмотру: {counts['to_watch']}", parse_mode="Markdown")
+            await query.edit_message_text(f"✅ *{title}* добавлен\n📋 К просмотру: {to_watch_count}", parse_mode="Markdown")
         else:
             await query.edit_message_text(f"⚠️ *{title}* уже в списке!", parse_mode="Markdown")
 
@@ -986,15 +1299,7 @@ async def batch_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     added_by = update.effective_user.first_name
     
-    added = []
-    skipped = []
-    
-    for title in movies:
-        success, _ = add_movie_db(chat_id, title, added_by)
-        if success:
-            added.append(title)
-        else:
-            skipped.append(title)
+    added, skipped, to_watch_count = await asyncio.to_thread(add_movies_db, chat_id, movies, added_by)
     
     parts = []
     if added:
@@ -1007,8 +1312,7 @@ async def batch_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if skipped:
         parts.append(f"\n⚠️ Уже в списке ({len(skipped)})")
     
-    counts = get_counts_db(chat_id)
-    parts.append(f"\n📋 Всего к просмотру: {counts['to_watch']}")
+    parts.append(f"\n📋 Всего к просмотру: {to_watch_count}")
     
     await update.message.reply_text("\n".join(parts))
 
@@ -1057,18 +1361,42 @@ async def list_movies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         except (ValueError, IndexError):
             pass
     
-    to_watch = get_movies_db(chat_id, "to_watch")
+    text, reply_markup = await asyncio.to_thread(
+        build_list_page, chat_id, page_num, page_size, search_query, show_all_pages
+    )
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown" if reply_markup else None)
+
+
+def build_list_page(chat_id: int, page_num: int, page_size: int,
+                    search_query: str | None, show_all: bool) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Render a /list page, reusing the cached render while the chat is unchanged.
+    
+    Returns the message text and keyboard; the keyboard is None when there is
+    nothing to show and the text is the empty/not-found notice instead.
+    """
+    key = (chat_id, page_num, page_size, search_query, show_all)
+    version = chat_version(chat_id)
+    cached = cache_get(_list_page_cache, key, version)
+    if cached:
+        return cached
+    
+    result = _render_list_page(chat_id, page_num, page_size, search_query, show_all)
+    cache_put(_list_page_cache, key, version, result, LIST_PAGE_CACHE_SIZE)
+    return result
+
+
+def _render_list_page(chat_id: int, page_num: int, page_size: int,
+                      search_query: str | None, show_all: bool) -> tuple[str, InlineKeyboardMarkup | None]:
+    to_watch = get_movie_list_db(chat_id, "to_watch")
     
     if not to_watch:
-        await update.message.reply_text("📭 Список пуст! Добавь фильмы через /add")
-        return
+        return "📭 Список пуст! Добавь фильмы через /add", None
     
     # Apply search filter
     if search_query:
         to_watch = [m for m in to_watch if search_query.lower() in m["title"].lower()]
         if not to_watch:
-            await update.message.reply_text(f"🔍 Не найдено: '{search_query}'")
-            return
+            return f"🔍 Не найдено: '{search_query}'", None
     
     # Paginate
     total_pages = (len(to_watch) + page_size - 1) // page_size
@@ -1084,17 +1412,14 @@ async def list_movies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         header += f"🔍 Поиск: _{search_query}_\n"
     header += "\n"
     
-    lines = []
-    for i, movie in enumerate(page_movies, start + 1):
-        lines.append(format_movie(movie, i))
-    
+    lines = [format_movie(movie, i) for i, movie in enumerate(page_movies, start + 1)]
     message = header + "\n".join(lines)
     
     # Build keyboard
     keyboard = []
     
     # Number buttons (only if not -a flag and page size <= 10)
-    if not show_all_pages and len(page_movies) <= 10:
+    if not show_all and len(page_movies) <= 10:
         row1 = []
         row2 = []
         for i, movie in enumerate(page_movies):
@@ -1113,14 +1438,13 @@ async def list_movies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     # Pagination row
     nav_row = []
     if page_num > 1:
-        nav_row.append(InlineKeyboardButton("◀️", callback_data=f"list_{page_num - 1}_{page_size}_{search_query or ''}_{show_all_pages}"))
+        nav_row.append(InlineKeyboardButton("◀️", callback_data=f"list_{page_num - 1}_{page_size}_{search_query or ''}_{show_all}"))
     nav_row.append(InlineKeyboardButton(f"{page_num}/{total_pages}", callback_data="noop"))
     if page_num < total_pages:
-        nav_row.append(InlineKeyboardButton("▶️", callback_data=f"list_{page_num + 1}_{page_size}_{search_query or ''}_{show_all_pages}"))
+        nav_row.append(InlineKeyboardButton("▶️", callback_data=f"list_{page_num + 1}_{page_size}_{search_query or ''}_{show_all}"))
     keyboard.append(nav_row)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode="Markdown")
+    return message, InlineKeyboardMarkup(keyboard)
 
 
 async def pages_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1140,7 +1464,7 @@ async def pages_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 async def show_page(message, chat_id: int, page: int, edit: bool = False) -> None:
     """Show a page of movies with buttons."""
-    to_watch = get_movies_db(chat_id, "to_watch")
+    to_watch = await asyncio.to_thread(get_movie_list_db, chat_id, "to_watch")
     
     if not to_watch:
         text = "📭 Список пуст! Добавь фильмы через /add"
@@ -1160,9 +1484,7 @@ async def show_page(message, chat_id: int, page: int, edit: bool = False) -> Non
     
     # Build text
     parts = [f"📋 *К просмотру* (стр. {page + 1}/{total_pages}):\n"]
-    
-    for i, movie in enumerate(page_movies, start_idx + 1):
-        parts.append(format_movie(movie, i))
+    parts.extend([format_movie(movie, i) for i, movie in enumerate(page_movies, start_idx + 1)])
     
     # Build keyboard - 2 rows of 5 number buttons
     keyboard = []
@@ -1230,63 +1552,12 @@ async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         search_query = parts[2] if parts[2] else None
         show_all = parts[3] == "True" if len(parts) > 3 else False
         
-        to_watch = get_movies_db(chat_id, "to_watch")
-        
-        # Apply search
-        if search_query:
-            to_watch = [m for m in to_watch if search_query.lower() in m["title"].lower()]
+        message, reply_markup = await asyncio.to_thread(build_list_page, chat_id, page, page_size, search_query, show_all)
         
-        if not to_watch:
+        if not reply_markup:
             await query.answer("Список пуст", show_alert=True)
             return
         
-        # Paginate
-        total_pages = (len(to_watch) + page_size - 1) // page_size
-        page = max(1, min(page, total_pages))
-        
-        start = (page - 1) * page_size
-        end = start + page_size
-        page_movies = to_watch[start:end]
-        
-        # Build message
-        header = f"📋 *К просмотру* (стр. {page}/{total_pages})\n"
-        if search_query:
-            header += f"🔍 Поиск: _{search_query}_\n"
-        header += "\n"
-        
-        lines = [format_movie(m, start + i + 1) for i, m in enumerate(page_movies)]
-        message = header + "\n".join(lines)
-        
-        # Build keyboard
-        keyboard = []
-        
-        # Number buttons (only if not show_all and <= 10)
-        if not show_all and len(page_movies) <= 10:
-            row1 = []
-            row2 = []
-            for i, movie in enumerate(page_movies):
-                num = start + i + 1
-                btn = InlineKeyboardButton(str(num), callback_data=f"movie_{movie['id']}")
-                if i < 5:
-                    row1.append(btn)
-                else:
-                    row2.append(btn)
-            
-            if row1:
-                keyboard.append(row1)
-            if row2:
-                keyboard.append(row2)
-        
-        # Pagination row
-        nav_row = []
-        if page > 1:
-            nav_row.append(InlineKeyboardButton("◀️", callback_data=f"list_{page - 1}_{page_size}_{search_query or ''}_{show_all}"))
-        nav_row.append(InlineKeyboardButton(f"{page}/{total_pages}", callback_data="noop"))
-        if page < total_pages:
-            nav_row.append(InlineKeyboardButton("▶️", callback_data=f"list_{page + 1}_{page_size}_{search_query or ''}_{show_all}"))
-        keyboard.append(nav_row)
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(message, parse_mode="Markdown", reply_markup=reply_markup)
     
     elif data.startswith("lpage_"):
@@ -1295,7 +1566,7 @@ async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     
     elif data.startswith("movie_"):
         movie_id = int(data.replace("movie_", ""))
-        movie = get_movie_by_id(chat_id, movie_id)
+        movie = await asyncio.to_thread(get_movie_by_id, chat_id, movie_id)
         
         if movie:
             await show_movie_detail(query, movie, chat_id)
@@ -1339,7 +1610,7 @@ async def movie_action_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     if data.startswith("w_"):
         movie_id = int(data.replace("w_", ""))
-        success, title = mark_watched_by_id(chat_id, movie_id, user_name)
+        success, title, _ = await asyncio.to_thread(mark_watched_by_id, chat_id, movie_id, user_name)
         
         if success:
             await query.answer(f"✅ {title} просмотрен!", show_alert=True)
@@ -1349,7 +1620,7 @@ async def movie_action_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif data.startswith("d_"):
         movie_id = int(data.replace("d_", ""))
-        title = remove_movie_by_id(chat_id, movie_id)
+        title = await asyncio.to_thread(remove_movie_by_id, chat_id, movie_id)
         
         if title:
             await query.answer(f"🗑 {title} удалён!", show_alert=True)
@@ -1359,7 +1630,7 @@ async def movie_action_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif data.startswith("r_"):
         movie_id = int(data.replace("r_", ""))
-        movie = get_movie_by_id(chat_id, movie_id)
+        movie = await asyncio.to_thread(get_movie_by_id, chat_id, movie_id)
         
         if movie:
             # Store movie_id for rename
@@ -1393,7 +1664,7 @@ async def movie_action_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def show_list_page(message, chat_id: int, page: int, edit: bool = False) -> None:
     """Show list page for back_to_list button."""
-    to_watch = get_movies_db(chat_id, "to_watch")
+    to_watch = await asyncio.to_thread(get_movie_list_db, chat_id, "to_watch")
     
     if not to_watch:
         text = "📭 Список пуст!"
@@ -1469,7 +1740,7 @@ async def watched_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     elif data.startswith("wmovie_"):
         movie_id = int(data.replace("wmovie_", ""))
-        movie = get_movie_by_id(chat_id, movie_id)
+        movie = await asyncio.to_thread(get_movie_by_id, chat_id, movie_id)
         
         if movie and movie["status"] == "watched":
             await show_watched_movie_detail(query, movie, chat_id)
@@ -1479,15 +1750,36 @@ async def watched_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 async def show_watched_page(message, chat_id: int, page: int, edit: bool = False) -> None:
     """Show a page of watched movies with buttons."""
-    watched = get_movies_db(chat_id, "watched")
+    text, reply_markup = await asyncio.to_thread(build_watched_page, chat_id, page)
+    parse_mode = "Markdown" if reply_markup else None
+    
+    if edit:
+        await message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+    else:
+        await message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+
+
+def build_watched_page(chat_id: int, page: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Render a watched page, reusing the cached render while the chat is unchanged.
+    
+    The keyboard is None when nothing has been watched yet.
+    """
+    key = (chat_id, page)
+    version = chat_version(chat_id)
+    cached = cache_get(_watched_page_cache, key, version)
+    if cached:
+        return cached
+    
+    result = _render_watched_page(chat_id, page)
+    cache_put(_watched_page_cache, key, version, result, WATCHED_PAGE_CACHE_SIZE)
+    return result
+
+
+def _render_watched_page(chat_id: int, page: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    watched = get_movie_list_db(chat_id, "watched")
     
     if not watched:
-        text = "📭 Просмотренных фильмов пока нет"
-        if edit:
-            await message.edit_text(text)
-        else:
-            await message.reply_text(text)
-        return
+        return "📭 Просмотренных фильмов пока нет", None
     
     per_page = 10
     total_pages = (len(watched) + per_page - 1) // per_page
@@ -1500,13 +1792,7 @@ async def show_watched_page(message, chat_id: int, page: int, edit: bool = False
     # Build text
     parts = [f"✅ *Просмотренные фильмы* (стр. {page + 1}/{total_pages}):\n"]
     
-    for i, movie in enumerate(page_movies, start_idx + 1):
-        line = f"{i}. {movie['title']}"
-        if movie.get("year"):
-            line += f" ({movie['year']})"
-        if movie.get("rating"):
-            line += f" ⭐{movie['rating']:.1f}"
-        parts.append(line)
+    parts.extend([format_movie(movie, i) for i, movie in enumerate(page_movies, start_idx + 1)])
     
     # Build keyboard
     keyboard = []
@@ -1539,12 +1825,7 @@ async def show_watched_page(message, chat_id: int, page: int, edit: bool = False
     
     keyboard.append(nav_row)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    if edit:
-        await message.edit_text("\n".join(parts), parse_mode="Markdown", reply_markup=reply_markup)
-    else:
-        await message.reply_text("\n".join(parts), parse_mode="Markdown", reply_markup=reply_markup)
+    return "\n".join(parts), InlineKeyboardMarkup(keyboard)
 
 
 async def show_watched_movie_detail(query, movie: dict, chat_id: int) -> None:
@@ -1581,7 +1862,7 @@ async def watched_action_callback(update: Update, context: ContextTypes.DEFAULT_
     
     if data.startswith("unw_"):
         movie_id = int(data.replace("unw_", ""))
-        success, title = unwatch_movie_by_id(chat_id, movie_id)
+        success, title = await asyncio.to_thread(unwatch_movie_by_id, chat_id, movie_id)
         
         if success:
             await query.answer(f"↩️ {title} возвращён в список!", show_alert=True)
@@ -1591,7 +1872,7 @@ async def watched_action_callback(update: Update, context: ContextTypes.DEFAULT_
     
     elif data.startswith("wd_"):
         movie_id = int(data.replace("wd_", ""))
-        title = remove_movie_by_id(chat_id, movie_id)
+        title = await asyncio.to_thread(remove_movie_by_id, chat_id, movie_id)
         
         if title:
             await query.answer(f"🗑 {title} удалён!", show_alert=True)
@@ -1616,13 +1897,17 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     
     chat_id = update.effective_chat.id
-    to_watch = get_movies_db(chat_id, "to_watch")
+    to_watch = await asyncio.to_thread(get_movie_list_db, chat_id, "to_watch")
     
     if num < 1 or num > len(to_watch):
         await update.message.reply_text(f"❌ Номер должен быть 1-{len(to_watch)}")
         return
     
-    movie = to_watch[num - 1]
+    # Number lookup from the cached list, full row for just this movie
+    movie = await asyncio.to_thread(get_movie_by_id, chat_id, to_watch[num - 1]["id"])
+    if not movie:
+        await update.message.reply_text("❌ Фильм не найден")
+        return
     
     parts = [f"🎬 *{movie['title']}*\n"]
     
@@ -1643,13 +1928,20 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     # Show poster if available
     if movie.get("poster_path") and TMDB_API_KEY:
-        poster_url = f"{TMDB_IMAGE_URL}{movie['poster_path']}"
-        await update.message.reply_photo(
-            poster_url,
+        poster_path = movie["poster_path"]
+        file_id = _poster_file_ids.get(poster_path)
+        sent = await update.message.reply_photo(
+            file_id or f"{TMDB_IMAGE_URL}{poster_path}",
             caption="\n".join(parts),
             parse_mode="Markdown",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
+        if file_id:
+            _poster_file_ids.move_to_end(poster_path)
+        elif sent.photo:
+            _poster_file_ids[poster_path] = sent.photo[-1].file_id
+            if len(_poster_file_ids) > POSTER_FILE_ID_CACHE_SIZE:
+                _poster_file_ids.popitem(last=False)
     else:
         await update.message.reply_text(
             "\n".join(parts),
@@ -1666,33 +1958,27 @@ async def mark_watched(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     chat_id = update.effective_chat.id
     watched_by = update.effective_user.first_name
-    to_watch = get_movies_db(chat_id, "to_watch")
     
-    # Try as number first
+    # Try as number first, resolved and updated in one statement
     try:
         num = int(context.args[0])
-        if 1 <= num <= len(to_watch):
-            movie = to_watch[num - 1]
-            success, title = mark_watched_by_id(chat_id, movie['id'], watched_by)
-            
-            if success:
-                counts = get_counts_db(chat_id)
-                await update.message.reply_text(
-                    f"✅ *{title}* просмотрен!\n📋 Осталось: {counts['to_watch']} | ✅ Просмотрено: {counts['watched']}",
-                    parse_mode="Markdown"
-                )
-            else:
-                await update.message.reply_text(f"ℹ️ *{title}* уже просмотрен", parse_mode="Markdown")
-            return
     except ValueError:
-        pass
+        num = None
+    
+    if num is not None and 1 <= num <= MAX_LIST_NUMBER:
+        title, counts = await asyncio.to_thread(mark_watched_by_number, chat_id, num, watched_by)
+        if title:
+            await update.message.reply_text(
+                f"✅ *{title}* просмотрен!\n📋 Осталось: {counts['to_watch']} | ✅ Просмотрено: {counts['watched']}",
+                parse_mode="Markdown"
+            )
+            return
     
     # Fallback to search by name
     search = " ".join(context.args).strip()
-    success, title = mark_watched_db(chat_id, search, watched_by)
+    success, title, counts = await asyncio.to_thread(mark_watched_db, chat_id, search, watched_by)
     
     if success:
-        counts = get_counts_db(chat_id)
         await update.message.reply_text(
             f"✅ *{title}* просмотрен!\n📋 Осталось: {counts['to_watch']} | ✅ Просмотрено: {counts['watched']}",
             parse_mode="Markdown"
@@ -1710,24 +1996,22 @@ async def remove_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     
     chat_id = update.effective_chat.id
-    to_watch = get_movies_db(chat_id, "to_watch")
     
-    # Try as number first
+    # Try as number first, resolved and deleted in one statement
     try:
         num = int(context.args[0])
-        if 1 <= num <= len(to_watch):
-            movie = to_watch[num - 1]
-            title = remove_movie_by_id(chat_id, movie['id'])
-            
-            if title:
-                await update.message.reply_text(f"🗑️ *{title}* удалён", parse_mode="Markdown")
-            return
     except ValueError:
-        pass
+        num = None
+    
+    if num is not None and 1 <= num <= MAX_LIST_NUMBER:
+        title = await asyncio.to_thread(remove_movie_by_number, chat_id, num)
+        if title:
+            await update.message.reply_text(f"🗑️ *{title}* удалён", parse_mode="Markdown")
+            return
     
     # Fallback to search by name
     search = " ".join(context.args).strip()
-    title = remove_movie_db(chat_id, search)
+    title = await asyncio.to_thread(remove_movie_db, chat_id, search)
     
     if title:
         await update.message.reply_text(f"🗑️ *{title}* удалён", parse_mode="Markdown")
@@ -1745,7 +2029,7 @@ async def rename_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     
     chat_id = update.effective_chat.id
-    to_watch = get_movies_db(chat_id, "to_watch")
+    to_watch = await asyncio.to_thread(get_movie_list_db, chat_id, "to_watch")
     
     try:
         num = int(context.args[0])
@@ -1764,7 +2048,7 @@ async def rename_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     
     movie = to_watch[num - 1]
-    success, old_title = rename_movie_by_id(chat_id, movie['id'], new_title)
+    success, old_title = await asyncio.to_thread(rename_movie_by_id, chat_id, movie['id'], new_title)
     
     if success:
         await update.message.reply_text(
@@ -1783,13 +2067,12 @@ async def rename_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def random_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    to_watch = get_movies_db(chat_id, "to_watch")
+    chosen = await asyncio.to_thread(pick_random_movie_db, chat_id)
     
-    if not to_watch:
+    if not chosen:
         await update.message.reply_text("📭 Список пуст!")
         return
     
-    chosen = random.choice(to_watch)
     text = f"🎲 *{chosen['title']}*"
     if chosen.get("year"):
         text += f" ({chosen['year']})"
@@ -1801,11 +2084,6 @@ async def random_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def create_poll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    to_watch = get_movies_db(chat_id, "to_watch")
-    
-    if not to_watch:
-        await update.message.reply_text("📭 Список пуст!")
-        return
     
     num = 3
     if context.args:
@@ -1814,16 +2092,18 @@ async def create_poll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         except ValueError:
             pass
     
-    if len(to_watch) < num:
-        num = len(to_watch)
+    # LIMIT already clamps to the list size, so no separate count is needed
+    chosen = await asyncio.to_thread(sample_to_watch_db, chat_id, num)
     
-    if num < 2:
-        chosen = random.choice(to_watch)
-        await update.message.reply_text(f"🎬 Только один вариант:\n*{chosen['title']}*", parse_mode="Markdown")
+    if not chosen:
+        await update.message.reply_text("📭 Список пуст!")
+        return
+    
+    if len(chosen) < 2:
+        await update.message.reply_text(f"🎬 Только один вариант:\n*{chosen[0]}*", parse_mode="Markdown")
         return
     
-    chosen = random.sample(to_watch, num)
-    options = [movie["title"][:100] for movie in chosen]
+    options = [title[:100] for title in chosen]
     
     await update.effective_chat.send_poll(
         question="🎬 Что смотрим?",
@@ -1838,11 +2118,8 @@ async def vote_poll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("❌ Укажи номера:\n`/vote 1,5,12`", parse_mode="Markdown")
         return
     
-    input_text = " ".join(context.args).replace(",", " ")
-    
-    try:
-        numbers = [int(n.strip()) for n in input_text.split() if n.strip()]
-    except ValueError:
+    numbers = parse_numbers(" ".join(context.args))
+    if numbers is None:
         await update.message.reply_text("❌ Неверный формат")
         return
     
@@ -1855,7 +2132,7 @@ async def vote_poll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     chat_id = update.effective_chat.id
-    to_watch = get_movies_db(chat_id, "to_watch")
+    to_watch = await asyncio.to_thread(get_movie_list_db, chat_id, "to_watch")
     
     selected = []
     invalid = []
@@ -1885,28 +2162,20 @@ async def random_from_selection(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("❌ Укажи номера:\n`/rpoll 1,5,12`", parse_mode="Markdown")
         return
     
-    input_text = " ".join(context.args).replace(",", " ")
-    
-    try:
-        numbers = [int(n.strip()) for n in input_text.split() if n.strip()]
-    except ValueError:
+    numbers = parse_numbers(" ".join(context.args))
+    if numbers is None:
         await update.message.reply_text("❌ Неверный формат")
         return
     
     chat_id = update.effective_chat.id
-    to_watch = get_movies_db(chat_id, "to_watch")
-    
-    selected = []
-    for num in numbers:
-        if 1 <= num <= len(to_watch):
-            selected.append(to_watch[num - 1])
+    numbers = [n for n in numbers if 1 <= n <= MAX_LIST_NUMBER]
+    chosen = await asyncio.to_thread(pick_random_numbered_db, chat_id, numbers)
     
-    if not selected:
+    if not chosen:
         await update.message.reply_text("❌ Нет валидных фильмов")
         return
     
-    chosen = random.choice(selected)
-    await update.message.reply_text(f"🎲 *{chosen['title']}*", parse_mode="Markdown")
+    await update.message.reply_text(f"🎲 *{chosen}*", parse_mode="Markdown")
 
 
 async def suggest_movies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1918,14 +2187,14 @@ async def suggest_movies(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     # Get watched genres
-    genres = get_watched_genres(chat_id)
+    genres = await asyncio.to_thread(get_watched_genres, chat_id)
     
     if not genres:
         await update.message.reply_text("❌ Нужно сначала посмотреть фильмы с TMDB данными для рекомендаций")
         return
     
     # Get already known movies to exclude
-    exclude_ids = get_watched_tmdb_ids(chat_id)
+    exclude_ids = await asyncio.to_thread(get_watched_tmdb_ids, chat_id)
     
     # Discover movies by genres
     recommendations = await tmdb_discover_by_genres(genres, exclude_ids)
@@ -1985,7 +2254,7 @@ async def wlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         except (ValueError, IndexError):
             pass
     
-    watched = get_movies_db(chat_id, "watched")
+    watched = await asyncio.to_thread(get_movie_list_db, chat_id, "watched")
     
     if not watched:
         await update.message.reply_text("📭 Просмотренных фильмов пока нет")
@@ -2013,15 +2282,7 @@ async def wlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         header += f"🔍 Поиск: _{search_query}_\n"
     header += "\n"
     
-    lines = []
-    for i, movie in enumerate(page_movies, start + 1):
-        line = f"{i}. {movie['title']}"
-        if movie.get("year"):
-            line += f" ({movie['year']})"
-        if movie.get("rating"):
-            line += f" ⭐{movie['rating']:.1f}"
-        lines.append(line)
-    
+    lines = [format_movie(movie, i) for i, movie in enumerate(page_movies, start + 1)]
     message = header + "\n".join(lines)
     
     # Build keyboard
@@ -2067,10 +2328,10 @@ async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     # Get movies based on status
     if sync_watched:
-        movies = get_movies_db(chat_id, "watched")
+        movies = await asyncio.to_thread(get_movies_db, chat_id, "watched")
         status_name = "просмотренных"
     else:
-        movies = get_movies_db(chat_id, "to_watch")
+        movies = await asyncio.to_thread(get_movies_db, chat_id, "to_watch")
         status_name = "к просмотру"
     
     if not movies:
@@ -2301,10 +2562,10 @@ async def sync_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             year = int(tmdb_movie.get("release_date", "0000")[:4]) if tmdb_movie.get("release_date") else None
             rating = tmdb_movie.get("vote_average")
             poster_path = tmdb_movie.get("poster_path")
-            genres = ",".join(map(str, tmdb_movie.get("genre_ids", [])))
+            genres = tmdb_movie.get("genre_ids", [])
             
-            success = update_movie_tmdb_data(
-                chat_id, movie["id"], int(tmdb_id),
+            success = await asyncio.to_thread(
+                update_movie_tmdb_data, chat_id, movie["id"], int(tmdb_id),
                 year=year, rating=rating, poster_path=poster_path, genres=genres
             )
             
@@ -2347,14 +2608,23 @@ async def export_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     # Check if CSV format requested
     export_csv = "-csv" in args or "csv" in args
     
-    movies = get_movies_db(chat_id)
+    # Query, formatting and encoding all stay off the event loop
+    export = await asyncio.to_thread(build_export_file, chat_id, export_csv)
     
-    if not movies:
+    if not export:
         await update.message.reply_text("📭 Список пуст!")
         return
     
-    to_watch = [m for m in movies if m["status"] == "to_watch"]
-    watched = [m for m in movies if m["status"] == "watched"]
+    file, caption = export
+    await update.message.reply_document(file, caption=caption)
+
+
+def build_export_file(chat_id: int, export_csv: bool) -> tuple[BytesIO, str] | None:
+    """Build the /export document and its caption; None when the chat has no movies."""
+    to_watch, watched = get_all_movies_db(chat_id)
+    
+    if not to_watch and not watched:
+        return None
     
     if export_csv:
         # CSV format
@@ -2375,7 +2645,7 @@ async def export_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 movie.get("year") or "",
                 movie.get("rating") or "",
                 movie.get("tmdb_id") or "",
-                movie.get("genres") or "",
+                ",".join(map(str, movie.get("genres") or [])),
                 movie.get("added_by") or "",
                 movie.get("added_at").strftime("%Y-%m-%d %H:%M:%S") if movie.get("added_at") else "",
                 "",
@@ -2390,7 +2660,7 @@ async def export_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 movie.get("year") or "",
                 movie.get("rating") or "",
                 movie.get("tmdb_id") or "",
-                movie.get("genres") or "",
+                ",".join(map(str, movie.get("genres") or [])),
                 movie.get("added_by") or "",
                 movie.get("added_at").strftime("%Y-%m-%d %H:%M:%S") if movie.get("added_at") else "",
                 movie.get("watched_by") or "",
@@ -2401,19 +2671,13 @@ async def export_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         file = BytesIO(content.encode("utf-8"))
         file.name = "watchlist.csv"
         
-        await update.message.reply_document(file, caption=f"📊 Экспорт: {len(to_watch)} к просмотру, {len(watched)} просмотрено")
+        return file, f"📊 Экспорт: {len(to_watch)} к просмотру, {len(watched)} просмотрено"
     
     else:
         # Text format
         lines = ["MOVIE WATCHLIST", "=" * 40, "", "TO WATCH:", "-" * 20]
         
-        for i, movie in enumerate(to_watch, 1):
-            line = f"{i}. {movie['title']}"
-            if movie.get("year"):
-                line += f" ({movie['year']})"
-            if movie.get("rating"):
-                line += f" ⭐{movie['rating']:.1f}"
-            lines.append(line)
+        lines.extend([format_movie(movie, i) for i, movie in enumerate(to_watch, 1)])
         
         lines.extend(["", "WATCHED:", "-" * 20])
         
@@ -2429,7 +2693,7 @@ async def export_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         file = BytesIO(content.encode("utf-8"))
         file.name = "watchlist.txt"
         
-        await update.message.reply_document(file, caption="📄 Твой список фильмов")
+        return file, "📄 Твой список фильмов"
 
 
 # ============== VOTE BASKET COMMANDS ==============
@@ -2442,11 +2706,8 @@ async def basket_add_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("❌ Укажи номера:\n`/v+ 1,5,12`", parse_mode="Markdown")
         return
     
-    input_text = input_text.replace(",", " ")
-    
-    try:
-        numbers = [int(n.strip()) for n in input_text.split() if n.strip()]
-    except ValueError:
+    numbers = parse_numbers(input_text)
+    if numbers is None:
         await update.message.reply_text("❌ Неверный формат")
         return
     
@@ -2454,15 +2715,14 @@ async def basket_add_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name
     
-    to_watch = get_movies_db(chat_id, "to_watch")
-    valid = [n for n in numbers if 1 <= n <= len(to_watch)]
-    invalid = [n for n in numbers if n not in valid]
+    to_watch = await asyncio.to_thread(get_movie_list_db, chat_id, "to_watch")
+    invalid = [n for n in numbers if not 1 <= n <= len(to_watch)]
     
     if invalid:
         await update.message.reply_text(f"❌ Неверные номера: {', '.join(map(str, invalid))}")
         return
     
-    added, exists = add_to_basket(chat_id, user_id, user_name, valid)
+    added, exists = await asyncio.to_thread(add_to_basket, chat_id, user_id, user_name, numbers)
     
     parts = []
     if added:
@@ -2482,19 +2742,16 @@ async def basket_remove_handler(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.effective_user.id
     
     if not input_text:
-        count = remove_from_basket(chat_id, user_id)
+        count = await asyncio.to_thread(remove_from_basket, chat_id, user_id)
         await update.message.reply_text(f"🗑️ Корзина очищена ({count})")
         return
     
-    input_text = input_text.replace(",", " ")
-    
-    try:
-        numbers = [int(n.strip()) for n in input_text.split() if n.strip()]
-    except ValueError:
+    numbers = parse_numbers(input_text)
+    if numbers is None:
         await update.message.reply_text("❌ Неверный формат")
         return
     
-    count = remove_from_basket(chat_id, user_id, numbers)
+    count = await asyncio.to_thread(remove_from_basket, chat_id, user_id, numbers)
     await update.message.reply_text(f"🗑️ Удалено: {count}")
 
 
@@ -2502,18 +2759,14 @@ async def basket_my(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
-    nums = get_user_basket(chat_id, user_id)
+    basket = await asyncio.to_thread(get_user_basket_with_titles, chat_id, user_id)
     
-    if not nums:
+    if not basket:
         await update.message.reply_text("📭 Твоя корзина пуста")
         return
     
-    to_watch = get_movies_db(chat_id, "to_watch")
-    
     parts = ["🛒 *Твоя корзина:*\n"]
-    for num in nums:
-        if 1 <= num <= len(to_watch):
-            parts.append(f"{num}. {to_watch[num-1]['title']}")
+    parts.extend([f"{item['movie_num']}. {item['title']}" for item in basket if item["title"]])
     
     await update.message.reply_text("\n".join(parts), parse_mode="Markdown")
 
@@ -2521,30 +2774,22 @@ async def basket_my(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def basket_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     
-    basket = get_full_basket(chat_id)
+    basket = await asyncio.to_thread(get_full_basket_with_titles, chat_id)
     
     if not basket:
         await update.message.reply_text("📭 Корзина пуста")
         return
     
-    to_watch = get_movies_db(chat_id, "to_watch")
-    
-    by_user = {}
-    for item in basket:
-        name = item["user_name"]
-        if name not in by_user:
-            by_user[name] = []
-        by_user[name].append(item["movie_num"])
-    
+    # Rows come ordered by user_name, so each user's items are contiguous
     parts = ["🛒 *Общая корзина:*\n"]
-    for user_name, nums in by_user.items():
-        movies = [f"{num}. {to_watch[num-1]['title']}" for num in nums if 1 <= num <= len(to_watch)]
+    for user_name, items in itertools.groupby(basket, key=lambda item: item["user_name"]):
+        movies = [f"{item['movie_num']}. {item['title']}" for item in items if item["title"]]
         if movies:
             parts.append(f"*{user_name}:*")
             parts.extend(movies)
             parts.append("")
     
-    unique = get_unique_basket_movies(chat_id)
+    unique = {item["movie_num"] for item in basket}
     parts.append(f"📊 Уникальных: {len(unique)}")
     
     await update.message.reply_text("\n".join(parts), parse_mode="Markdown")
@@ -2553,22 +2798,21 @@ async def basket_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 async def basket_go(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     
-    unique_nums = get_unique_basket_movies(chat_id)
+    unique = await asyncio.to_thread(get_unique_basket_titles, chat_id)
     
-    if not unique_nums:
+    if not unique:
         await update.message.reply_text("📭 Корзина пуста!")
         return
     
-    if len(unique_nums) < 2:
+    if len(unique) < 2:
         await update.message.reply_text("❌ Нужно минимум 2 фильма")
         return
     
-    if len(unique_nums) > 10:
-        await update.message.reply_text(f"❌ Максимум 10. Сейчас: {len(unique_nums)}")
+    if len(unique) > 10:
+        await update.message.reply_text(f"❌ Максимум 10. Сейчас: {len(unique)}")
         return
     
-    to_watch = get_movies_db(chat_id, "to_watch")
-    options = [to_watch[num-1]["title"][:100] for num in unique_nums if 1 <= num <= len(to_watch)]
+    options = [item["title"][:100] for item in unique if item["title"]]
     
     if len(options) < 2:
         await update.message.reply_text("❌ Недостаточно фильмов")
@@ -2585,26 +2829,22 @@ async def basket_go(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def basket_random(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     
-    unique_nums = get_unique_basket_movies(chat_id)
+    has_basket, chosen = await asyncio.to_thread(pick_random_basket_title, chat_id)
     
-    if not unique_nums:
+    if not has_basket:
         await update.message.reply_text("📭 Корзина пуста!")
         return
     
-    to_watch = get_movies_db(chat_id, "to_watch")
-    valid = [num for num in unique_nums if 1 <= num <= len(to_watch)]
-    
-    if not valid:
+    if not chosen:
         await update.message.reply_text("❌ Нет валидных фильмов")
         return
     
-    chosen = to_watch[random.choice(valid) - 1]
-    await update.message.reply_text(f"🎲 *{chosen['title']}*", parse_mode="Markdown")
+    await update.message.reply_text(f"🎲 *{chosen}*", parse_mode="Markdown")
 
 
 async def basket_clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    count = clear_basket(chat_id)
+    count = await asyncio.to_thread(clear_basket, chat_id)
     await update.message.reply_text(f"🗑️ Корзина очищена ({count})")
 
 
@@ -2622,7 +2862,7 @@ async def handle_rename_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("❌ Название не может быть пустым")
         return
     
-    success, old_title = rename_movie_by_id(chat_id, movie_id, new_title)
+    success, old_title = await asyncio.to_thread(rename_movie_by_id, chat_id, movie_id, new_title)
     
     if success:
         # Add "Back to list" button
@@ -2669,7 +2909,7 @@ async def wheel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     # Получаем фильмы из корзины с шансами
-    movies = get_basket_movies_with_chances(chat_id)
+    movies = await asyncio.to_thread(get_basket_movies_with_chances, chat_id)
     
     if not movies:
         await update.message.reply_text(
@@ -2683,7 +2923,7 @@ async def wheel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     
     # Создаем короткий уникальный session_id (только timestamp)
     import hashlib
-    timestamp = int(datetime.now().timestamp())
+    timestamp = int(time.time())
     # Хэш от chat_id + user_id для уникальности
     hash_str = hashlib.md5(f"{chat_id}{user_id}".encode()).hexdigest()[:8]
     session_id = f"{timestamp}{hash_str}"
@@ -2778,54 +3018,33 @@ async def wheel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 def save_wheel_session(session_id: str, movies: list) -> None:
     """Сохранить session данные для рулетки."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Создать таблицу если не существует
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS wheel_sessions (
-            session_id VARCHAR(255) PRIMARY KEY,
-            movies_data JSONB NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            expires_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP + INTERVAL '1 hour'
+    with db_cursor() as cur:
+        # Очистить старые сессии (старше 1 часа)
+        cur.execute("DELETE FROM wheel_sessions WHERE expires_at < CURRENT_TIMESTAMP")
+        
+        # Сохранить данные
+        cur.execute(
+            "INSERT INTO wheel_sessions (session_id, movies_data) VALUES (%s, %s) "
+            "ON CONFLICT (session_id) DO UPDATE SET movies_data = EXCLUDED.movies_data",
+            (session_id, json.dumps(movies))
         )
-    """)
-    
-    # Очистить старые сессии (старше 1 часа)
-    cur.execute("DELETE FROM wheel_sessions WHERE expires_at < CURRENT_TIMESTAMP")
-    
-    # Сохранить данные
-    cur.execute(
-        "INSERT INTO wheel_sessions (session_id, movies_data) VALUES (%s, %s) "
-        "ON CONFLICT (session_id) DO UPDATE SET movies_data = EXCLUDED.movies_data",
-        (session_id, json.dumps(movies))
-    )
-    
-    conn.commit()
-    cur.close()
-    conn.close()
 
 
 def get_wheel_session(session_id: str) -> list | None:
     """Получить session данные для рулетки."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute(
-            "SELECT movies_data FROM wheel_sessions WHERE session_id = %s AND expires_at > CURRENT_TIMESTAMP",
-            (session_id,)
-        )
-        row = cur.fetchone()
+        with db_cursor() as cur:
+            cur.execute(
+                "SELECT movies_data FROM wheel_sessions WHERE session_id = %s AND expires_at > CURRENT_TIMESTAMP",
+                (session_id,)
+            )
+            row = cur.fetchone()
         
         if row:
             return json.loads(row["movies_data"])
         return None
     except:
         return None
-    finally:
-        cur.close()
-        conn.close()
 
 
 # ============== ПОЛУЧЕНИЕ ФИЛЬМОВ С ШАНСАМИ ==============
@@ -2837,29 +3056,24 @@ def get_basket_movies_with_chances(chat_id: int) -> list:
     Базовая версия: равные шансы для всех.
     Можно добавить модификаторы (см. ниже).
     """
-    # Получаем уникальные номера из корзины
-    unique_nums = get_unique_basket_movies(chat_id)
+    # Уникальные номера из корзины вместе с фильмами
+    unique = get_unique_basket_titles(chat_id)
     
-    if not unique_nums:
+    if not unique:
         return []
     
-    # Получаем список фильмов
-    to_watch = get_movies_db(chat_id, "to_watch")
-    
     # Формируем данные для рулетки
     movies = []
     
-    for num in unique_nums:
-        if 1 <= num <= len(to_watch):
-            movie = to_watch[num - 1]
-            
+    for item in unique:
+        if item["title"]:
             # Базовый шанс = 100 / количество фильмов
-            chance = 100.0 / len(unique_nums)
+            chance = 100.0 / len(unique)
             
             movies.append({
-                "title": movie["title"],
+                "title": item["title"],
                 "chance": chance,
-                "movie_id": movie["id"]  # На будущее для модификаторов
+                "movie_id": item["movie_id"]  # На будущее для модификаторов
             })
     
     return movies
@@ -2874,32 +3088,29 @@ def get_basket_movies_with_chances_advanced(chat_id: int) -> list:
     Модификатор:
     - Победитель в прошлый раз: -50%
     """
-    unique_nums = get_unique_basket_movies(chat_id)
+    unique = get_unique_basket_titles(chat_id)
     
-    if not unique_nums:
+    if not unique:
         return []
     
-    to_watch = get_movies_db(chat_id, "to_watch")
     movies = []
     
     # Получаем последнего победителя (если есть)
     last_winner_id = get_last_wheel_winner(chat_id)
     
-    for num in unique_nums:
-        if 1 <= num <= len(to_watch):
-            movie = to_watch[num - 1]
-            
+    for item in unique:
+        if item["title"]:
             # Базовый шанс
-            chance = 100.0 / len(unique_nums)
+            chance = 100.0 / len(unique)
             
             # Модификатор: победитель в прошлый раз
-            if last_winner_id and movie["id"] == last_winner_id:
+            if last_winner_id and item["movie_id"] == last_winner_id:
                 chance *= 0.5  # -50%
             
             movies.append({
-                "title": movie["title"],
+                "title": item["title"],
                 "chance": chance,
-                "movie_id": movie["id"]
+                "movie_id": item["movie_id"]
             })
     
     # Нормализовать шансы (чтобы сумма = 100)
@@ -2915,55 +3126,33 @@ def get_basket_movies_with_chances_advanced(chat_id: int) -> list:
 def save_wheel_winner(chat_id: int, movie_title: str) -> None:
     """Сохранить победителя рулетки для следующего раза."""
     # Найти movie_id по названию
-    to_watch = get_movies_db(chat_id, "to_watch")
+    to_watch = get_movie_list_db(chat_id, "to_watch")
     movie = next((m for m in to_watch if m["title"] == movie_title), None)
     
     if movie:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Создать таблицу если не существует
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS wheel_history (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT NOT NULL,
-                movie_id INT NOT NULL,
-                movie_title VARCHAR(255),
-                winner_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        with db_cursor() as cur:
+            # Сохранить победителя
+            cur.execute(
+                "INSERT INTO wheel_history (chat_id, movie_id, movie_title) VALUES (%s, %s, %s)",
+                (chat_id, movie["id"], movie_title)
             )
-        """)
-        
-        # Сохранить победителя
-        cur.execute(
-            "INSERT INTO wheel_history (chat_id, movie_id, movie_title) VALUES (%s, %s, %s)",
-            (chat_id, movie["id"], movie_title)
-        )
-        
-        conn.commit()
-        cur.close()
-        conn.close()
 
 
 def get_last_wheel_winner(chat_id: int) -> int | None:
     """Получить ID последнего победителя рулетки."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     try:
-        cur.execute("""
-            SELECT movie_id FROM wheel_history 
-            WHERE chat_id = %s 
-            ORDER BY winner_at DESC 
-            LIMIT 1
-        """, (chat_id,))
-        
-        row = cur.fetchone()
+        with db_cursor() as cur:
+            cur.execute("""
+                SELECT movie_id FROM wheel_history 
+                WHERE chat_id = %s 
+                ORDER BY winner_at DESC 
+                LIMIT 1
+            """, (chat_id,))
+            
+            row = cur.fetchone()
         return row["movie_id"] if row else None
     except:
         return None
-    finally:
-        cur.close()
-        conn.close()
 
 
 # ============== ОБРАБОТЧИК РЕЗУЛЬТАТА ==============
@@ -2976,7 +3165,7 @@ async def handle_wheel_result(update: Update, context: ContextTypes.DEFAULT_TYPE
         chat_id = update.effective_message.chat_id
         
         # Сохранить победителя
-        save_wheel_winner(chat_id, winner)
+        await asyncio.to_thread(save_wheel_winner, chat_id, winner)
         
         # Объявить в чате
         await update.effective_message.reply_text(
@@ -3023,7 +3212,7 @@ async def announce_wheel_result(update: Update, context: ContextTypes.DEFAULT_TY
             
             # Сохранить победителя
             chat_id = update.effective_chat.id
-            save_wheel_winner(chat_id, winner)
+            await asyncio.to_thread(save_wheel_winner, chat_id, winner)
             
             # Объявить результат
             await query.message.reply_text(
@@ -3040,8 +3229,57 @@ async def announce_wheel_result(update: Update, context: ContextTypes.DEFAULT_TY
         )
 
 
+# ============== UPDATE PROCESSING ==============
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates from different chats concurrently, one at a time per chat.
+    
+    Keeps e.g. two quick /add commands in one chat from racing each other
+    while other chats are served in parallel.
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        self._chat_pending: dict[int, int] = {}
+    
+    async def process_update(self, update: object, coroutine) -> None:
+        # Wait for the chat's turn before taking a concurrency slot, so a
+        # busy chat's queue doesn't hold slots other chats could use
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        
+        chat_id = chat.id
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        self._chat_pending[chat_id] = self._chat_pending.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            # Drop the lock once nobody from this chat is queued on it
+            self._chat_pending[chat_id] -= 1
+            if not self._chat_pending[chat_id]:
+                del self._chat_pending[chat_id]
+                del self._chat_locks[chat_id]
+    
+    async def do_process_update(self, update: object, coroutine) -> None:
+        await coroutine
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+
 # ============== MAIN ==============
 
+async def close_tmdb_client(application: Application) -> None:
+    await tmdb_client.aclose()
+
+
 def main() -> None:
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     
@@ -3051,7 +3289,23 @@ def main() -> None:
     
     init_db()
     
-    application = Application.builder().token(token).build()
+    # Each in-flight update holds at most one pooled connection at a time,
+    # so capping concurrency at the pool size keeps getconn() from failing.
+    application = (
+        Application.builder()
+        .token(token)
+        .request(HTTPXRequest(
+            connection_pool_size=TELEGRAM_POOL_SIZE,
+            pool_timeout=5.0,
+            read_timeout=10.0,
+        ))
+        .concurrent_updates(ChatOrderedUpdateProcessor(DB_POOL_MAX_CONN))
+        # Stay under Telegram's flood limits (30 msg/s overall, 20 msg/min
+        # per group) and retry on RetryAfter instead of failing the handler
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_shutdown(close_tmdb_client)
+        .build()
+    )
     
     # Basic commands
     application.add_handler(CommandHandler("start", start))
@@ -3079,9 +3333,10 @@ def main() -> None:
     ))
     application.add_handler(CallbackQueryHandler(announce_wheel_result, pattern=r"^wheel_result_"))
     
-    # Vote basket
-    application.add_handler(MessageHandler(filters.Regex(r'^/v\+'), basket_add_handler))
-    application.add_handler(MessageHandler(filters.Regex(r'^/v-'), basket_remove_handler))
+    # Vote basket (Telegram tags "/v+" as a "/v" command, so the cheap COMMAND
+    # check keeps ordinary chat messages away from the regexes)
+    application.add_handler(MessageHandler(filters.COMMAND & filters.Regex(r'^/v\+'), basket_add_handler))
+    application.add_handler(MessageHandler(filters.COMMAND & filters.Regex(r'^/v-'), basket_remove_handler))
     application.add_handler(CommandHandler("vmy", basket_my))
     application.add_handler(CommandHandler("vlist", basket_list))
     application.add_handler(CommandHandler("go", basket_go))